@@ -1,7 +1,21 @@
 import argparse
+import getpass
+import os
 
 from .enhance_export import enhance_export
+from .enhance_export import enhance_exports
 from .enhance_export import EnhanceExportException
+from .shards import merge_shards
+
+
+def positive_int(value: str) -> int:
+    try:
+        n = int(value)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return n
 
 
 def main():
@@ -43,6 +57,15 @@ def main():
         help="ignore errors updating individual books and keep processing",
     )
 
+    argument_parser.add_argument(
+        "--ratings_only",
+        action="store_true",
+        help=(
+            "only refresh the number of ratings of all books (uses the smallest page"
+            " that has it, instead of the full book page)"
+        ),
+    )
+
     argument_parser.add_argument(
         "--genre_votes",
         help=(
@@ -51,6 +74,77 @@ def main():
         ),
     )
 
+    argument_parser.add_argument(
+        "-b",
+        "--batch",
+        nargs="+",
+        metavar="CSV",
+        help=(
+            "process several export files (e.g. of different users) in one run, book"
+            " and genre pages are only downloaded once for all of them"
+        ),
+    )
+
+    argument_parser.add_argument(
+        "-w",
+        "--workers",
+        type=positive_int,
+        default=1,
+        help="number of books to process concurrently (default 1)",
+    )
+
+    argument_parser.add_argument(
+        "--shard",
+        help=(
+            'only process shard K of N (e.g. "2/4"), books are assigned by Book Id'
+            " and the results are written to a separate .shardKofN.csv file"
+        ),
+    )
+
+    argument_parser.add_argument(
+        "--merge",
+        nargs="+",
+        metavar="SHARD_CSV",
+        help="merge the results of the given shard files into the --csv file",
+    )
+
+    argument_parser.add_argument(
+        "--sqlite",
+        metavar="DB",
+        help=(
+            "also write the results to this SQLite database (with one row per"
+            " reading session and per genre, indexed by end date and genre)"
+        ),
+    )
+
+    argument_parser.add_argument(
+        "--watch",
+        metavar="DIR",
+        help=(
+            "keep running and process every export file that is put into DIR (results"
+            " are written to DIR/enhanced), logs in only once so all files need to"
+            " belong to the same account"
+        ),
+    )
+
+    argument_parser.add_argument(
+        "--email",
+        help=(
+            "log in with this email address without opening a browser (the password"
+            " is read from the GOODREADS_PASSWORD environment variable or asked for),"
+            " the browser is still used if GoodReads shows a captcha"
+        ),
+    )
+
+    argument_parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help=(
+            "only print how many pages would be downloaded and an estimate of how"
+            " long that takes (based on the speed of the last run), without logging in"
+        ),
+    )
+
     argument_parser.add_argument("-g", "--gui", action="store_true", help="show GUI")
 
     options = vars(argument_parser.parse_args())
@@ -61,13 +155,48 @@ def main():
         launch_gui()
         return
 
-    if not options["csv"]:
+    if options["batch"] and options["update"]:
+        print("--update can't be combined with --batch")
+        return
+
+    if options["batch"] and options["csv"]:
+        print("--csv can't be combined with --batch (list all files after --batch)")
+        return
+
+    if options["batch"] and options["email"]:
+        print("--email can't be combined with --batch")
+        return
+
+    if options["dry_run"] and options["watch"]:
+        print("--dry-run can't be combined with --watch")
+        return
+
+    if not options["csv"] and not options["batch"] and not options["watch"]:
         print("You need to provide the path to the export file!")
         print()
         argument_parser.print_help()
         return
 
+    if options["email"] and not options["dry_run"] and not options["merge"]:
+        options["password"] = os.environ.get("GOODREADS_PASSWORD") or getpass.getpass(
+            "GoodReads password: "
+        )
+
     try:
+        if options["merge"]:
+            merge_shards(options["csv"], options["merge"])
+            return
+        if options["batch"]:
+            enhance_exports(options)
+            return
+        if options["watch"]:
+            from .watch import watch_directory
+
+            try:
+                watch_directory(options)
+            except KeyboardInterrupt:
+                print("Stopped watching")
+            return
         enhance_export(options)
     except EnhanceExportException as e:
         print(e.message)
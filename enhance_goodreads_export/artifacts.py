@@ -0,0 +1,86 @@
+import datetime
+import gzip
+import json
+import os
+import time
+
+from .config import ARTIFACTS_MAX_BYTES
+from .config import ARTIFACTS_MAX_COUNT
+from .entities import PageParseError
+from .entities import Path
+
+
+class FailureArtifacts:
+    """Saves pages that couldn't be parsed to gzipped files in directory
+
+    Pages are truncated to max_bytes. The directory keeps at most max_count
+    pages (over all runs and instances), the oldest are deleted to make room.
+    index.jsonl in the directory lists the kept pages with book and reason.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        max_count: int = ARTIFACTS_MAX_COUNT,
+        max_bytes: int = ARTIFACTS_MAX_BYTES,
+    ) -> None:
+        self.directory = directory
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.index_filename = os.path.join(directory, "index.jsonl")
+
+    def _saved_pages(self) -> list[str]:
+        """File names of the saved pages, oldest first (they start with the time)"""
+        return sorted(
+            name for name in os.listdir(self.directory) if name.endswith(".html.gz")
+        )
+
+    def _prune(self) -> None:
+        """Deletes the oldest pages (and their index entries) above max_count"""
+        pages = self._saved_pages()
+        if len(pages) <= self.max_count:
+            return
+        for name in pages[: len(pages) - self.max_count]:
+            os.remove(os.path.join(self.directory, name))
+        kept = set(pages[len(pages) - self.max_count :])
+        if not os.path.exists(self.index_filename):
+            return
+        with open(self.index_filename, encoding="utf-8") as f:
+            lines = [
+                line for line in f if line.strip() and json.loads(line)["file"] in kept
+            ]
+        with open(self.index_filename, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+
+    def save(self, book: dict[str, str], error: PageParseError) -> str:
+        """Saves the page of the error, returns a short reference to it"""
+        if self.max_count < 1:
+            return "page not saved"
+        filename = os.path.join(
+            self.directory,
+            f"{datetime.datetime.now():%Y%m%d-%H%M%S-%f}-{book['Book Id']}.html.gz",
+        )
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with gzip.open(filename, "wb") as f:
+                f.write(error.page[: self.max_bytes])
+            with open(self.index_filename, "a", encoding="utf-8") as f:
+                f.write(
+                    json.dumps(
+                        {
+                            "file": os.path.basename(filename),
+                            "book_id": book["Book Id"],
+                            "title": book.get("Title", ""),
+                            "url": error.url,
+                            "reason": str(error),
+                            "size": len(error.page),
+                            "truncated": len(error.page) > self.max_bytes,
+                            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                        }
+                    )
+                    + "\n"
+                )
+            self._prune()
+        except (OSError, ValueError, KeyError) as e:
+            return f"could not save page: {e}"
+        return f"page saved to {filename}"
@@ -0,0 +1,123 @@
+import threading
+import time
+
+import requests
+
+from .config import BREAKER_MAX_FAILURES
+from .config import BREAKER_MAX_PROBES
+from .config import BREAKER_PAUSE
+from .entities import AbsoluteUrl
+from .entities import EnhanceExportException
+
+
+class CircuitOpenException(EnhanceExportException):
+    pass
+
+
+class SignedOutException(CircuitOpenException):
+    """The breaker aborted because GoodReads logged us out, log in again"""
+
+
+class SignInRedirect(requests.exceptions.RequestException):
+    """A request was redirected to the sign-in page (the breaker then aborts)"""
+
+
+def is_sign_in_url(url: str) -> bool:
+    return "/user/sign_in" in url or "/ap/signin" in url
+
+
+def is_site_failure(e: Exception) -> bool:
+    """Whether the error says something about the site (rather than one book)"""
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        return e.response.status_code >= 500 or e.response.status_code == 429
+    return isinstance(e, requests.exceptions.RequestException)
+
+
+class CircuitBreaker:
+    """Stops all requests while GoodReads is down or has logged us out
+
+    After max_failures failed requests in a row the breaker trips: the next
+    request pauses, then probes probe_url until it works again. If it doesn't
+    after max_probes attempts, this and all further requests raise
+    CircuitOpenException. A redirect to the sign-in page aborts right away with
+    SignedOutException, waiting doesn't log us in again (and the public
+    probe_url would still work).
+    Shared between all worker threads.
+    """
+
+    def __init__(
+        self,
+        probe_url: AbsoluteUrl,
+        max_failures: int = BREAKER_MAX_FAILURES,
+        pause: float = BREAKER_PAUSE,
+        max_probes: int = BREAKER_MAX_PROBES,
+    ) -> None:
+        self.probe_url = probe_url
+        self.max_failures = max_failures
+        self.pause = pause
+        self.max_probes = max_probes
+        self._condition = threading.Condition()
+        self.n_failures = 0
+        self.state = "closed"  # "closed", "tripped", "probing" or "aborted"
+        self.abort_message = "GoodReads didn't recover, aborting!"
+        self.signed_out = False
+
+    def before_request(self, session: requests.Session) -> None:
+        with self._condition:
+            while self.state != "closed":
+                if self.state == "aborted":
+                    if self.signed_out:
+                        raise SignedOutException(self.abort_message)
+                    raise CircuitOpenException(self.abort_message)
+                if self.state == "tripped":
+                    self.state = "probing"
+                    break
+                self._condition.wait()
+            else:
+                return
+
+        recovered = self._probe(session)
+        with self._condition:
+            self.n_failures = 0
+            if self.state != "aborted":
+                self.state = "closed" if recovered else "aborted"
+            self._condition.notify_all()
+        self.before_request(session)
+
+    def _probe(self, session: requests.Session) -> bool:
+        for i in range(self.max_probes):
+            print(
+                f"GoodReads seems to be unavailable, pausing for {self.pause:.0f}s"
+                f" (attempt {i + 1} of {self.max_probes})"
+            )
+            time.sleep(self.pause)
+            try:
+                resp = session.get(self.probe_url, timeout=10)
+            except requests.exceptions.RequestException:
+                continue
+            if resp.ok and not is_sign_in_url(resp.url):
+                print("GoodReads is reachable again, continuing")
+                return True
+        return False
+
+    def record_success(self) -> None:
+        with self._condition:
+            self.n_failures = 0
+
+    def record_failure(self, e: Exception) -> None:
+        if not is_site_failure(e):
+            return
+        with self._condition:
+            if isinstance(e, SignInRedirect):
+                if self.state != "aborted":
+                    self.abort_message = (
+                        "GoodReads logged us out (redirected to the sign-in page),"
+                        " aborting!"
+                    )
+                    self.state = "aborted"
+                    self.signed_out = True
+                    self._condition.notify_all()
+                return
+            self.n_failures += 1
+            if self.state == "closed" and self.n_failures >= self.max_failures:
+                self.state = "tripped"
@@ -1,3 +1,5 @@
+import os
+
 from .entities import AbsoluteUrl
 
 
@@ -13,6 +15,49 @@ BASE_URL = AbsoluteUrl("https://www.goodreads.com")
 POST_LOGIN_URL = AbsoluteUrl("https://www.goodreads.com/")
 LOGIN_URL = AbsoluteUrl("https://www.goodreads.com/user/sign_in")
 
+# number of per-host connection pools kept by the session
+# (we only talk to www.goodreads.com, plus the odd redirect)
+MAX_POOLS = 4
+
+# circuit breaker: trip after this many failed requests in a row, then check
+# every BREAKER_PAUSE seconds whether the site is back, give up after
+# BREAKER_MAX_PROBES checks
+BREAKER_MAX_FAILURES = 10
+BREAKER_PAUSE = 60
+BREAKER_MAX_PROBES = 5
+
+# watch mode: how often to look for new exports and where to put the results
+# (relative to the watched directory)
+WATCH_POLL_INTERVAL = 5
+WATCH_OUTPUT_DIR = "enhanced"
+
+# how long long-running processes (watch mode, GUI worker) reuse parsed pages
+PERSISTENT_CACHE_MAX_AGE = 24 * 60 * 60
+
+# max number of parsed pages kept by enhance_book_jobs / enhance_books when the
+# caller doesn't pass a cache, so memory doesn't grow with the number of books
+STREAMING_CACHE_MAX_ENTRIES = 1000
+
+# pages that couldn't be parsed are saved (gzipped) to this directory next to
+# the export file, truncated to ARTIFACTS_MAX_BYTES, only the newest
+# ARTIFACTS_MAX_COUNT are kept
+ARTIFACTS_DIR = "failed_pages"
+ARTIFACTS_MAX_BYTES = 2 * 1024 * 1024
+ARTIFACTS_MAX_COUNT = 50
+
+# the review page of books on these shelves is only fetched if they have a
+# Date Read, the others can't have read dates
+SHELVES_WITHOUT_READ_DATES = {"to-read"}
+
+# throughput of the last run (for --dry-run estimates), only saved for runs
+# with at least THROUGHPUT_MIN_REQUESTS requests, DEFAULT_REQUESTS_PER_SEC
+# (per worker) is assumed before the first one
+THROUGHPUT_FILE = os.path.join(
+    os.path.expanduser("~"), ".enhance_goodreads_export_throughput.json"
+)
+THROUGHPUT_MIN_REQUESTS = 20
+DEFAULT_REQUESTS_PER_SEC = 1.0
+
 
 STANDARD_FIELDNAMES = [
     "Book Id",
@@ -22,6 +67,8 @@ STANDARD_FIELDNAMES = [
     "Exclusive Shelf",
 ]
 
+ENHANCED_FIELDNAMES = ["read_dates", "genres", "n_ratings"]
+
 IGNORE_GENRES = {
     "to-read",
     "currently-reading",
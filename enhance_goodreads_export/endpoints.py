@@ -0,0 +1,68 @@
+import threading
+
+
+class EndpointStats:
+    def __init__(self) -> None:
+        self.n_ok = 0
+        self.n_failures = 0
+        self.n_bytes = 0
+        self.parse_time = 0.0
+
+    @property
+    def avg_bytes(self) -> float:
+        return self.n_bytes / self.n_ok if self.n_ok else 0
+
+    @property
+    def avg_parse_time(self) -> float:
+        return self.parse_time / self.n_ok if self.n_ok else 0
+
+
+class EndpointSelector:
+    """Orders alternative endpoints for the same data by their measured cost
+
+    Endpoints that haven't been tried yet come first (in the given order) so
+    each gets measured once, then they are sorted by average page size and parse
+    time. An endpoint that fails more often than it works (after max_failures
+    failures) isn't used anymore.
+    """
+
+    def __init__(self, names: list[str], max_failures: int = 3) -> None:
+        self.names = names
+        self.max_failures = max_failures
+        self._lock = threading.Lock()
+        self.stats = {name: EndpointStats() for name in names}
+
+    def _is_disabled(self, stats: EndpointStats) -> bool:
+        return stats.n_failures >= self.max_failures and stats.n_failures > stats.n_ok
+
+    def candidates(self) -> list[str]:
+        with self._lock:
+            return sorted(
+                (n for n in self.names if not self._is_disabled(self.stats[n])),
+                key=lambda n: (
+                    self.stats[n].n_ok + self.stats[n].n_failures > 0,
+                    self.stats[n].avg_bytes,
+                    self.stats[n].avg_parse_time,
+                    self.names.index(n),
+                ),
+            )
+
+    def record_success(self, name: str, n_bytes: int, parse_time: float) -> None:
+        with self._lock:
+            stats = self.stats[name]
+            stats.n_ok += 1
+            stats.n_bytes += n_bytes
+            stats.parse_time += parse_time
+
+    def record_failure(self, name: str) -> None:
+        with self._lock:
+            self.stats[name].n_failures += 1
+
+    def report(self) -> str:
+        with self._lock:
+            return "; ".join(
+                f"{name}: {s.n_ok} ok ({s.avg_bytes / 1024:.1f} KiB,"
+                f" {s.avg_parse_time * 1000:.1f} ms parsing on average),"
+                f" {s.n_failures} failed"
+                for name, s in self.stats.items()
+            )
@@ -1,24 +1,58 @@
 import csv
 import datetime
+import functools
+import itertools
+import os
 import re
+import time
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from dataclasses import dataclass
 from typing import Callable
+from typing import Iterable
+from typing import Iterator
+from typing import NamedTuple
 
 import backoff
 import dateutil.parser
 import requests
 from bs4 import BeautifulSoup
 
+from .artifacts import FailureArtifacts
+from .circuit_breaker import CircuitBreaker
+from .circuit_breaker import CircuitOpenException
+from .circuit_breaker import is_sign_in_url
+from .circuit_breaker import SignInRedirect
+from .config import ARTIFACTS_DIR
 from .config import BASE_URL
 from .config import BOOK_URL
+from .config import ENHANCED_FIELDNAMES
 from .config import IGNORE_GENRE_SUBSTRINGS
 from .config import IGNORE_GENRES
 from .config import REVIEW_URL
 from .config import STANDARD_FIELDNAMES
 from .config import STATS_URL
+from .config import STREAMING_CACHE_MAX_ENTRIES
+from .endpoints import EndpointSelector
 from .entities import AbsoluteUrl
 from .entities import EnhanceExportException
+from .entities import PageParseError
 from .entities import Path
+from .login import connection_stats
+from .login import format_connection_stats
 from .login import login
+from .page_cache import PageCache
+from .planner import estimate_duration
+from .planner import needs_review_page
+from .planner import plan_requests
+from .planner import RequestPlan
+from .planner import save_throughput
+from .progress import ProgressCallback
+from .progress import ProgressPrinter
+from .progress import ProgressTracker
+from .sqlite_output import SqliteOutput
 
 
 def parse_csv(filename: Path) -> list[dict[str, str]]:
@@ -53,9 +87,22 @@ def write_csv(data: list[dict], fieldnames: list[str], filename: Path) -> None:
 @backoff.on_exception(
     backoff.expo, requests.exceptions.RequestException, max_tries=3, max_time=2
 )
-def get_with_retry(session, *args, **kwargs) -> requests.Response:
-    resp = session.get(*args, timeout=10, **kwargs)
-    resp.raise_for_status()
+def get_with_retry(
+    session: requests.Session, url: str, breaker: CircuitBreaker | None = None
+) -> requests.Response:
+    if breaker is not None:
+        breaker.before_request(session)
+    try:
+        resp = session.get(url, timeout=10)
+        resp.raise_for_status()
+        if is_sign_in_url(resp.url):
+            raise SignInRedirect(f"Redirected to sign-in page getting {url}")
+    except requests.exceptions.RequestException as e:
+        if breaker is not None:
+            breaker.record_failure(e)
+        raise
+    if breaker is not None:
+        breaker.record_success()
     return resp
 
 
@@ -119,12 +166,7 @@ def valid_genre(genre: str, author) -> bool:
     return True
 
 
-def get_genres(
-    soup: BeautifulSoup,
-    min_n_votes: int | None,
-    min_n_votes_frac: float | None,
-    author: str,
-) -> list[tuple[list[str], int]]:
+def parse_shelves(soup: BeautifulSoup) -> list[tuple[str, int]]:
     genrelinks = soup.find_all(class_="shelfStat")
     genres = []
     for genre_link in genrelinks:
@@ -134,8 +176,17 @@ def get_genres(
                 (lines[0].strip(), int("".join(c for c in lines[1] if c.isdigit())))
             )
     genres.sort(key=lambda x: x[1], reverse=True)
+    return genres
+
+
+def filter_genres(
+    shelves: list[tuple[str, int]],
+    min_n_votes: int | None,
+    min_n_votes_frac: float | None,
+    author: str,
+) -> list[tuple[list[str], int]]:
     # format genre name
-    genres = [(g[0].replace("-", " ").title(), g[1]) for g in genres]
+    genres = [(g[0].replace("-", " ").title(), g[1]) for g in shelves]
 
     # filter out useless shelves (e.g. to-read)
     genres = [g for g in genres if valid_genre(g[0], author)]
@@ -153,56 +204,202 @@ def get_genres(
 
     # genres used to support nested subgenres, this doesn't exist on the new book page.
     # To match the old format, treat all genres as 1 level (wrap name in list)
-    genres = [([g[0]], g[1]) for g in genres]
+    return [([g[0]], g[1]) for g in genres][:20]
 
-    return genres[:20]
+
+def get_genres(
+    soup: BeautifulSoup,
+    min_n_votes: int | None,
+    min_n_votes_frac: float | None,
+    author: str,
+) -> list[tuple[list[str], int]]:
+    return filter_genres(parse_shelves(soup), min_n_votes, min_n_votes_frac, author)
 
 
-@backoff.on_exception(backoff.expo, Exception, max_tries=3, max_time=2)
+def parse_n_ratings(page: str) -> str | None:
+    """Number of ratings from the JSON embedded in the page"""
+    n_ratings_match = re.search(
+        r'(?:"|&quot;)ratingsCount(?:"|&quot;)\s*:\s*(\d+)', page
+    )
+    return n_ratings_match.group(1) if n_ratings_match else None
+
+
+# alternative sources of the number of ratings: (url for book id, page parser)
+# both only use the embedded JSON, the stats page's text is a table of ratings
+# per day, so an endpoint without it fails (and isn't used anymore) instead of
+# guessing
+N_RATINGS_ENDPOINTS: dict[
+    str, tuple[Callable[[str], AbsoluteUrl], Callable[[str], str | None]]
+] = {
+    "stats": (make_stats_url, parse_n_ratings),
+    "book": (make_book_url, parse_n_ratings),
+}
+
+
+def get_book_info(
+    session: requests.Session, book_id: str, breaker: CircuitBreaker | None = None
+) -> tuple[str, AbsoluteUrl | None]:
+    """Returns number of ratings and url of the shelves page from the book page"""
+    book_url = make_book_url(book_id)
+    book_page_bytes = get_with_retry(session, book_url, breaker).content
+    book_page = book_page_bytes.decode("utf-8")
+    n_ratings = parse_n_ratings(book_page)
+    if n_ratings is None:
+        raise PageParseError(
+            "Did not find number of ratings in book page!", book_url, book_page_bytes
+        )
+
+    shelves_url_match = re.search(
+        '(?:"|&quot;)[^"&]*(work/shelves[^"&]+)(?:"|&quot;)', book_page
+    )
+    if shelves_url_match is None:
+        return n_ratings, None
+    return n_ratings, AbsoluteUrl(f"{BASE_URL}/{shelves_url_match.group(1)}")
+
+
+def get_n_ratings(
+    session: requests.Session,
+    book_id: str,
+    selector: EndpointSelector,
+    breaker: CircuitBreaker | None = None,
+) -> str:
+    """Number of ratings from the cheapest endpoint that works
+
+    Falls back to the next endpoint if a page can't be fetched or parsed. If no
+    page could be fetched at all, the last request error is raised.
+    """
+    unparsed_url, unparsed_page = "", b""
+    request_error: requests.exceptions.RequestException | None = None
+    for name in selector.candidates():
+        make_url, parse = N_RATINGS_ENDPOINTS[name]
+        url = make_url(book_id)
+        try:
+            page = get_with_retry(session, url, breaker).content
+        except requests.exceptions.RequestException as e:
+            selector.record_failure(name)
+            request_error = e
+            continue
+        start = time.perf_counter()
+        n_ratings = parse(page.decode("utf-8"))
+        if n_ratings is None:
+            selector.record_failure(name)
+            unparsed_url, unparsed_page = url, page
+            continue
+        selector.record_success(name, len(page), time.perf_counter() - start)
+        return n_ratings
+    if not unparsed_url:
+        if request_error is not None:
+            raise request_error
+        raise EnhanceExportException(
+            "All sources of the number of ratings failed too often, not trying again"
+        )
+    raise PageParseError(
+        "Did not find number of ratings on any page!", unparsed_url, unparsed_page
+    )
+
+
+def get_shelves(
+    session: requests.Session,
+    shelves_url: AbsoluteUrl,
+    breaker: CircuitBreaker | None = None,
+) -> list[tuple[str, int]]:
+    genres_page = get_with_retry(session, shelves_url, breaker)
+    return parse_shelves(BeautifulSoup(genres_page.content, "html.parser"))
+
+
+@backoff.on_exception(
+    backoff.expo,
+    Exception,
+    max_tries=3,
+    max_time=2,
+    giveup=lambda e: isinstance(e, CircuitOpenException),
+)
 def update_book_data(
-    book: dict[str, str], session: requests.Session, options: dict
+    book: dict[str, str],
+    session: requests.Session,
+    options: dict,
+    cache: PageCache | None = None,
+    breaker: CircuitBreaker | None = None,
 ) -> None:
+    """Adds read dates, number of ratings and genres to the book
+
+    The review page is fetched with the given session (it belongs to the user
+    whose export this is), book and shelves pages are shared via the cache.
+    Unread books on the to-read shelf get empty read dates without a request.
+    The book is only changed once all pages were fetched, so a book that fails
+    halfway is still processed on the next run.
+    """
+    if cache is None:
+        cache = PageCache()
     book_id = book["Book Id"]
     author = book.get("Author", "")
-
-    review_page = get_with_retry(session, make_review_url(book_id))
-    review_soup = BeautifulSoup(review_page.content, "html.parser")
-    read_dates = get_read_dates(review_soup)
-    book["read_dates"] = ";".join(
+    result = {}
+
+    read_dates = []
+    if needs_review_page(book):
+        review_page = get_with_retry(session, make_review_url(book_id), breaker)
+        review_soup = BeautifulSoup(review_page.content, "html.parser")
+        read_dates = get_read_dates(review_soup)
+    result["read_dates"] = ";".join(
         ",".join(d.strftime("%Y-%m-%d") if d else "" for d in reading)
         for reading in read_dates
     )
 
-    book_page = get_with_retry(session, make_book_url(book_id)).content.decode("utf-8")
-    n_ratings_match = re.search(
-        r'(?:"|&quot;)ratingsCount(?:"|&quot;)\s*:\s*(\d+)', book_page
+    n_ratings, shelves_url = cache.get(
+        "book", book_id, lambda: get_book_info(session, book_id, breaker)
     )
-    if n_ratings_match is None:
-        print(book_page)
-        raise ValueError("Did not find number of ratings in book page!")
-    book["n_ratings"] = n_ratings_match.group(1)
+    result["n_ratings"] = n_ratings
 
-    shelves_url_match = re.search(
-        '(?:"|&quot;)[^"&]*(work/shelves[^"&]+)(?:"|&quot;)', book_page
-    )
-    if shelves_url_match is None:
+    if shelves_url is None:
         print("Did not find link to shelves page on book page, not adding genres!")
+        book.update(result)
         return
-    shelves_url = AbsoluteUrl(f"{BASE_URL}/{shelves_url_match.group(1)}")
 
-    genres_page = get_with_retry(session, shelves_url)
-    genres_soup = BeautifulSoup(genres_page.content, "html.parser")
-    genres = get_genres(
-        genres_soup,
+    shelves = cache.get(
+        "shelves", shelves_url, lambda: get_shelves(session, shelves_url, breaker)
+    )
+    genres = filter_genres(
+        shelves,
         min_n_votes=options.get("genres_min_n_votes"),
         min_n_votes_frac=options.get("genres_min_n_votes_frac"),
         author=author,
     )
-    book["genres"] = ";".join(f"{','.join(genre[0])}|{genre[1]}" for genre in genres)
+    result["genres"] = ";".join(f"{','.join(genre[0])}|{genre[1]}" for genre in genres)
+    book.update(result)
 
 
-def enhance_export(options: dict, login_prompt: Callable | None = None) -> None:
-    if "genre_votes" in options:
+@backoff.on_exception(
+    backoff.expo,
+    Exception,
+    max_tries=3,
+    max_time=2,
+    giveup=lambda e: isinstance(e, CircuitOpenException),
+)
+def update_book_ratings(
+    book: dict[str, str],
+    session: requests.Session,
+    options: dict,
+    cache: PageCache,
+    breaker: CircuitBreaker,
+    selector: EndpointSelector,
+) -> None:
+    """Only updates the number of ratings (--ratings_only)"""
+    book_id = book["Book Id"]
+    book["n_ratings"] = cache.get(
+        "n_ratings", book_id, lambda: get_n_ratings(session, book_id, selector, breaker)
+    )
+
+
+@dataclass
+class ExportFile:
+    filename: Path  # results are written here
+    books: list[dict[str, str]]
+    output_columns: list[str]
+    books_to_process: list[dict[str, str]]
+
+
+def parse_genre_votes(options: dict) -> None:
+    if options.get("genre_votes"):
         try:
             genre_votes = float(
                 options["genre_votes"].strip().removesuffix("%").strip()
@@ -218,15 +415,32 @@ def enhance_export(options: dict, login_prompt: Callable | None = None) -> None:
         else:
             options["genres_min_n_votes"] = int(genre_votes)
 
-    books = parse_csv(options["csv"])
+
+def load_export(
+    filename: Path, update_filename: Path | None, options: dict
+) -> ExportFile:
+    books = parse_csv(filename)
     input_columns = list(books[0].keys())
     output_columns = input_columns + [
-        c for c in ["read_dates", "genres", "n_ratings"] if not c in input_columns
+        c for c in ENHANCED_FIELDNAMES if not c in input_columns
     ]
 
-    session = login(login_prompt=login_prompt)
-    if options["update"]:
-        old_books_by_id = {b["Book Id"]: b for b in parse_csv(options["update"])}
+    output_filename = filename
+    if options.get("shard"):
+        from .shards import book_shard
+        from .shards import parse_shard_spec
+        from .shards import shard_filename
+
+        shard, n_shards = parse_shard_spec(options["shard"])
+        books = [b for b in books if book_shard(b["Book Id"], n_shards) == shard]
+        output_filename = shard_filename(filename, shard, n_shards)
+        print(
+            f"Processing shard {shard} of {n_shards} ({len(books)} books), results"
+            f" will be written to {output_filename}"
+        )
+
+    if update_filename:
+        old_books_by_id = {b["Book Id"]: b for b in parse_csv(update_filename)}
         for b in books:
             # Update read_dates and genres from the old file for books that didn't change shelf and weren't re-read.
             ob = old_books_by_id.get(b["Book Id"], None)
@@ -244,6 +458,7 @@ def enhance_export(options: dict, login_prompt: Callable | None = None) -> None:
         for b in books
         if (
             options["force"]
+            or options.get("ratings_only")
             or (
                 not b.get("genres", None)
                 and not b.get("read_dates", None)
@@ -251,19 +466,274 @@ def enhance_export(options: dict, login_prompt: Callable | None = None) -> None:
             )
         )
     ]
-    for i, book in enumerate(books_to_process):
-        print(
-            f"Book {i+1} of {len(books_to_process)}: {book['Title']} ({book['Author']})"
-        )
-        try:
-            update_book_data(book, session, options)
-        except Exception as e:
+    return ExportFile(output_filename, books, output_columns, books_to_process)
+
+
+class BookResult(NamedTuple):
+    book: dict[str, str]
+    error: Exception | None
+
+
+def enhance_book_jobs(
+    jobs: Iterable[tuple[dict[str, str], requests.Session]],
+    options: dict,
+    cache: PageCache | None = None,
+    breaker: CircuitBreaker | None = None,
+) -> Iterator[BookResult]:
+    """Processes (book, session) pairs in a pool of options["workers"] threads
+
+    Yields the results in the order the books finish. Jobs are only taken from
+    the iterable as workers become free, so memory use doesn't grow with the
+    number of books. All requests go through one circuit breaker, if it gives up
+    the remaining books fail with CircuitOpenException.
+    Without a cache only the last STREAMING_CACHE_MAX_ENTRIES pages are kept.
+    """
+    if cache is None:
+        cache = PageCache(max_entries=STREAMING_CACHE_MAX_ENTRIES)
+    if breaker is None:
+        breaker = CircuitBreaker(BASE_URL)
+    selector = EndpointSelector(list(N_RATINGS_ENDPOINTS))
+    update: Callable = update_book_data
+    if options.get("ratings_only"):
+        update = functools.partial(update_book_ratings, selector=selector)
+    n_workers = options.get("workers") or 1
+    jobs = iter(jobs)
+    executor = ThreadPoolExecutor(max_workers=n_workers)
+    pending: dict[Future, dict[str, str]] = {}
+    try:
+        while True:
+            for book, session in itertools.islice(jobs, 2 * n_workers - len(pending)):
+                future = executor.submit(update, book, session, options, cache, breaker)
+                pending[future] = book
+            if not pending:
+                if options.get("ratings_only"):
+                    print(f"Number of ratings sources: {selector.report()}")
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                if error is not None and not isinstance(error, Exception):
+                    raise error
+                yield BookResult(pending.pop(future), error)
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def enhance_books(
+    books: Iterable[dict[str, str]],
+    session: requests.Session,
+    options: dict,
+    cache: PageCache | None = None,
+) -> Iterator[BookResult]:
+    """Library entry point: enhances rows of an export with a logged in session
+
+    The row dicts are updated in place and yielded (with the error, if any)
+    as soon as they are done, see enhance_book_jobs.
+    """
+    options = dict(options)
+    parse_genre_votes(options)
+    return enhance_book_jobs(((book, session) for book in books), options, cache)
+
+
+def plan_exports(
+    exports: list[ExportFile], options: dict, cache: PageCache | None = None
+) -> RequestPlan:
+    return plan_requests(
+        [export.books_to_process for export in exports],
+        sum(len(export.books) for export in exports),
+        ratings_only=bool(options.get("ratings_only")),
+        cache=cache,
+    )
+
+
+def print_dry_run(
+    exports: list[ExportFile], options: dict, cache: PageCache | None = None
+) -> None:
+    """--dry-run: prints the planned requests and how long they would take"""
+    plan = plan_exports(exports, options, cache)
+    print(plan.describe())
+    print(estimate_duration(plan, options.get("workers") or 1))
+
+
+def process_exports(
+    exports: list[tuple[ExportFile, requests.Session]],
+    options: dict,
+    cache: PageCache,
+    progress: ProgressCallback | None = None,
+    breaker: CircuitBreaker | None = None,
+    sqlite: SqliteOutput | None = None,
+    cancel: Callable[[], bool] | None = None,
+) -> None:
+    """Processes the books of all exports in one pool of worker threads
+
+    Only the books in the request plan are processed (each Book Id once per
+    export), rows with the same Book Id get a copy of the results.
+    Each export's file is saved every 20 processed books and when it's done.
+    Progress events go to the progress callback (throttled printing by default).
+    If given, every book is also written to the sqlite output, books that don't
+    need processing right away and the others as they finish.
+    Once cancel() returns True no new books are started, the running ones are
+    finished and all files saved.
+    """
+    if sqlite is not None:
+        for export, _ in exports:
+            to_process = {id(b) for b in export.books_to_process}
+            sqlite.write_books(
+                export.filename,
+                [book for book in export.books if id(book) not in to_process],
+            )
+
+    artifacts = FailureArtifacts(
+        Path(os.path.join(os.path.dirname(exports[0][0].filename), ARTIFACTS_DIR))
+    )
+
+    plan = plan_exports([export for export, _ in exports], options, cache)
+    print(plan.describe())
+    tracker = ProgressTracker(len(plan.jobs), progress or ProgressPrinter())
+    export_index_by_book: dict[int, int] = {}
+
+    def jobs() -> Iterator[tuple[dict[str, str], requests.Session]]:
+        for export_index, book in plan.jobs:
+            if cancel is not None and cancel():
+                return
+            tracker.started(book)
+            export_index_by_book[id(book)] = export_index
+            yield book, exports[export_index][1]
+
+    sessions = {id(session): session for _, session in exports}.values()
+    n_requests_before = sum(connection_stats(s)[0] for s in sessions)
+    start_time = time.monotonic()
+    n_jobs = [0] * len(exports)
+    for export_index, _ in plan.jobs:
+        n_jobs[export_index] += 1
+    n_remaining = n_jobs.copy()
+    for book, error in enhance_book_jobs(jobs(), options, cache, breaker):
+        tracker.finished(book, error)
+        if isinstance(error, CircuitOpenException):
+            # save what we have, a rerun continues with the unprocessed books
+            for export, _ in exports:
+                write_csv(export.books, export.output_columns, export.filename)
+            print("Saved progress, run again later to process the remaining books")
+            raise error
+        if error is not None:
+            reason = str(error)
+            if isinstance(error, PageParseError):
+                # only a reference to the (large) page goes to the output
+                reason += f" ({artifacts.save(book, error)})"
+                error.page = b""
             if options["ignore_errors"]:
-                print(f"Error updating book, skipping: {e}")
+                print(f"Error updating book, skipping: {reason}")
             else:
-                raise e
+                print(f"Error updating book: {reason}")
+                raise error
+
+        export_index = export_index_by_book.pop(id(book))
+        export = exports[export_index][0]
+        rows = [book]
+        if error is None:
+            for duplicate in plan.duplicates.get(id(book), []):
+                for column in ENHANCED_FIELDNAMES:
+                    duplicate[column] = book.get(column, "")
+                rows.append(duplicate)
+        if sqlite is not None:
+            sqlite.write_books(export.filename, rows)
+        n_remaining[export_index] -= 1
+        n_done = n_jobs[export_index] - n_remaining[export_index]
+        if n_done % 20 == 0 or n_remaining[export_index] == 0:
+            print("saving csv" if len(exports) == 1 else f"saving {export.filename}")
+            write_csv(export.books, export.output_columns, export.filename)
+
+    if cancel is not None and cancel():
+        for export, _ in exports:
+            write_csv(export.books, export.output_columns, export.filename)
+        print("Cancelled, saved progress")
+        return
+    save_throughput(
+        sum(connection_stats(s)[0] for s in sessions) - n_requests_before,
+        time.monotonic() - start_time,
+        options.get("workers") or 1,
+    )
 
-        if i % 20 == 19 or i == len(books_to_process) - 1:
-            print("saving csv")
-            write_csv(books, output_columns, options["csv"])
+
+def enhance_export(
+    options: dict,
+    login_prompt: Callable | None = None,
+    progress: ProgressCallback | None = None,
+    session: requests.Session | None = None,
+    cache: PageCache | None = None,
+    cancel: Callable[[], bool] | None = None,
+) -> None:
+    """Enhances options["csv"]
+
+    Logs in unless a session is given. Long-running callers can pass their
+    session and cache to reuse them between exports.
+    With options["dry_run"] only the planned requests are printed.
+    """
+    parse_genre_votes(options)
+    export = load_export(options["csv"], options["update"], options)
+    if options.get("dry_run"):
+        print_dry_run([export], options, cache)
+        return
+
+    if session is None:
+        session = login(
+            login_prompt=login_prompt,
+            n_workers=options.get("workers") or 1,
+            email=options.get("email"),
+            password=options.get("password"),
+        )
+    if cache is None:
+        cache = PageCache()
+    sqlite = SqliteOutput(options["sqlite"]) if options.get("sqlite") else None
+    try:
+        process_exports(
+            [(export, session)],
+            options,
+            cache,
+            progress,
+            sqlite=sqlite,
+            cancel=cancel,
+        )
+    finally:
+        if sqlite is not None:
+            sqlite.close()
+    if cancel is None or not cancel():
+        print("Finished processing!")
+    print(cache.stats())
+    print(format_connection_stats(session))
+
+
+def enhance_exports(
+    options: dict,
+    login_prompt: Callable | None = None,
+    progress: ProgressCallback | None = None,
+) -> None:
+    """Processes the export files in options["batch"] in one run
+
+    Each export needs a login with the account it belongs to (for the review
+    pages), book and shelves pages are only fetched once for all exports.
+    """
+    parse_genre_votes(options)
+    loaded = [load_export(filename, None, options) for filename in options["batch"]]
+    if options.get("dry_run"):
+        print_dry_run(loaded, options)
+        return
+    exports = []
+    for filename, export in zip(options["batch"], loaded):
+        print(f"Log in with the GoodReads account that {filename} belongs to")
+        session = login(
+            login_prompt=login_prompt, n_workers=options.get("workers") or 1
+        )
+        exports.append((export, session))
+
+    cache = PageCache()
+    sqlite = SqliteOutput(options["sqlite"]) if options.get("sqlite") else None
+    try:
+        process_exports(exports, options, cache, progress, sqlite=sqlite)
+    finally:
+        if sqlite is not None:
+            sqlite.close()
     print("Finished processing!")
+    print(cache.stats())
+    for filename, (_, session) in zip(options["batch"], exports):
+        print(f"{filename}: {format_connection_stats(session)}")
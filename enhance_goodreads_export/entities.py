@@ -9,3 +9,12 @@ Path = NewType("Path", str)
 class EnhanceExportException(Exception):
     def __init__(self, message):
         self.message = message
+
+
+class PageParseError(ValueError):
+    """A page didn't contain what we were looking for, keeps the page for debugging"""
+
+    def __init__(self, message: str, url: str, page: bytes):
+        super().__init__(message)
+        self.url = url
+        self.page = page
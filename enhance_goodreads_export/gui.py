@@ -1,14 +1,27 @@
 import functools
 import io
-import multiprocessing
+import multiprocessing.synchronize
 import queue
 import sys
 import tkinter as tk
 from tkinter import ttk
 from tkinter.filedialog import askopenfilename
 
+from .circuit_breaker import CircuitOpenException
+from .circuit_breaker import SignedOutException
+from .config import PERSISTENT_CACHE_MAX_AGE
 from .enhance_export import enhance_export
+from .enhance_export import parse_csv
 from .entities import EnhanceExportException
+from .login import login
+from .page_cache import PageCache
+from .progress import format_duration
+from .progress import ProgressEvent
+
+# keep only the end of the log so the Text widget doesn't grow without bound
+MAX_LOG_LINES = 2000
+# upper bound on queue items handled per update, so the GUI can't get stuck
+MAX_ITEMS_PER_UPDATE = 10000
 
 
 class IOQueue:
@@ -30,31 +43,79 @@ def human_tk_captcha_solver(
     return captcha_guess_queue.get(block=True)
 
 
-def task(
-    options: dict,
+def worker(
+    job_queue: queue.Queue,
+    status_queue: queue.Queue,
     stdout_queue: queue.Queue,
     captcha_data_queue: queue.Queue,
     captcha_guess_queue: queue.Queue,
+    cancel_event: multiprocessing.synchronize.Event,
 ):
-    sys.stdout = IOQueue(stdout_queue)  # type: ignore
+    """Runs in a separate process for the lifetime of the GUI
 
-    try:
+    Processes the jobs (options dicts) from job_queue one after another, keeping
+    the logged in session and page cache between them. Puts "logging in",
+    "processing" and (after each job) "done" on status_queue. If GoodReads
+    logged us out during a job, logs in again and continues it.
+    """
+    sys.stdout = IOQueue(stdout_queue)  # type: ignore
+    login_prompt = functools.partial(
+        human_tk_captcha_solver,
+        captcha_data_queue=captcha_data_queue,
+        captcha_guess_queue=captcha_guess_queue,
+    )
+    session = None
+    cache = PageCache(max_age=PERSISTENT_CACHE_MAX_AGE)
+
+    def run_job(options: dict) -> None:
+        nonlocal session
+        if session is None:
+            # fail on a bad export file before opening the browser
+            parse_csv(options["csv"])
+            status_queue.put("logging in")
+            session = login(login_prompt=login_prompt)
+            status_queue.put("processing")
         enhance_export(
             options,
-            login_prompt=functools.partial(
-                human_tk_captcha_solver,
-                captcha_data_queue=captcha_data_queue,
-                captcha_guess_queue=captcha_guess_queue,
-            ),
+            progress=stdout_queue.put,
+            session=session,
+            cache=cache,
+            cancel=cancel_event.is_set,
         )
-    except EnhanceExportException as e:
-        print(e.message)
+
+    while True:
+        options = job_queue.get(block=True)
+        try:
+            try:
+                run_job(options)
+            except SignedOutException as e:
+                # the progress so far is saved, continue with a new session
+                print(f"{e.message} Logging in again.")
+                session = None
+                run_job(options)
+        except CircuitOpenException as e:
+            # GoodReads is down (or logged us out again), start over next job
+            print(e.message)
+            session = None
+        except EnhanceExportException as e:
+            print(e.message)
+        except Exception as e:
+            print(f"Error: {e}")
+        finally:
+            cache.prune()
+            status_queue.put("done")
 
 
 class IOText(ttk.Frame):
+    """Log of the worker's output plus a progress bar for its ProgressEvents"""
+
     def __init__(self, text_queue: multiprocessing.Queue, *args, **kwargs):
         ttk.Frame.__init__(self, *args, **kwargs)
 
+        self.progress_label = ttk.Label(self, anchor=tk.W)
+        self.progress_label.pack(side="top", fill="x")
+        self.progress_bar = ttk.Progressbar(self, orient="horizontal")
+        self.progress_bar.pack(side="top", fill="x")
         self.text = tk.Text(self, height=6, width=100)
         self.vsb = ttk.Scrollbar(self, orient="vertical", command=self.text.yview)
         self.text.configure(yscrollcommand=self.vsb.set)
@@ -64,21 +125,44 @@ class IOText(ttk.Frame):
         self.update()
 
     def update(self):
-        try:
-            text = self.queue.get_nowait()
-        except queue.Empty:
-            text = None
+        # drain everything that arrived since the last tick, only the last
+        # progress event matters and the text is inserted in one go
+        texts = []
+        event = None
+        for _ in range(MAX_ITEMS_PER_UPDATE):
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, ProgressEvent):
+                event = item
+            else:
+                texts.append(item)
 
-        if text:
+        if texts:
             scroll = False
             if self.text.dlineinfo("end-1chars") is not None:  # autoscroll if at end
                 scroll = True
-            self.text.insert("end", text)
+            self.text.insert("end", "".join(texts))
+            self.text.delete("1.0", f"end-{MAX_LOG_LINES}lines")
             if scroll:
                 self.text.see("end")
 
+        if event is not None:
+            self.show_progress(event)
+
         self.after(100, self.update)
 
+    def show_progress(self, event: ProgressEvent) -> None:
+        self.progress_bar["maximum"] = max(event.n_total, 1)
+        self.progress_bar["value"] = event.n_done
+        errors = f", {event.n_errors} errors" if event.n_errors else ""
+        self.progress_label["text"] = (
+            f"{event.n_done} / {event.n_total} books{errors},"
+            f" {event.books_per_sec:.2f} books/s,"
+            f" ETA {format_duration(event.eta_sec)} - {event.title}"
+        )
+
 
 class EnhanceExportGui(tk.Tk):
     def __init__(self):
@@ -145,6 +229,11 @@ class EnhanceExportGui(tk.Tk):
             self.frame, text="start processing", command=self.start_processing
         )
         self.start_button.grid(row=7, column=0, columnspan=2, pady=5)
+        self.cancel_button = ttk.Button(
+            self.frame, text="cancel", command=self.cancel_processing
+        )
+        self.cancel_button.grid(row=7, column=2, sticky=tk.W, pady=5)
+        self.cancel_button["state"] = tk.DISABLED
 
         self.frame.grid_columnconfigure(0, weight=0)
         self.frame.grid_columnconfigure(1, weight=0)
@@ -158,6 +247,25 @@ class EnhanceExportGui(tk.Tk):
 
         self.captcha_data_queue = multiprocessing.Queue()
         self.captcha_guess_queue = multiprocessing.Queue()
+        self.job_queue = multiprocessing.Queue()
+        self.status_queue = multiprocessing.Queue()
+        self.cancel_event = multiprocessing.Event()
+        self.start_worker()
+
+    def start_worker(self) -> None:
+        self.worker_process = multiprocessing.Process(
+            target=worker,
+            args=(
+                self.job_queue,
+                self.status_queue,
+                self.stdout_queue,
+                self.captcha_data_queue,
+                self.captcha_guess_queue,
+                self.cancel_event,
+            ),
+            daemon=True,
+        )
+        self.worker_process.start()
 
     def submit_captcha(self):
         self.captcha_guess_queue.put(True)
@@ -204,33 +312,46 @@ class EnhanceExportGui(tk.Tk):
             "genre_votes": self.genreentry.get() or None,
         }
 
-        process = multiprocessing.Process(
-            target=task,
-            args=(
-                options,
-                self.stdout_queue,
-                self.captcha_data_queue,
-                self.captcha_guess_queue,
-            ),
-            daemon=True,
-        )
-        process.start()
+        if not self.worker_process.is_alive():
+            self.start_worker()
+        self.cancel_event.clear()
+        self.job_queue.put(options)
 
         def check_if_finished_or_captcha():
-            if process.is_alive():
+            while True:
                 try:
-                    self.captcha_data_queue.get_nowait()
+                    status = self.status_queue.get_nowait()
                 except queue.Empty:
-                    pass
-                else:
-                    self.captcha_window()
-                self.after(300, check_if_finished_or_captcha)
-            else:
+                    break
+                if status == "done":
+                    self.change_all_state(tk.NORMAL)
+                    return
+                # the job can't be cancelled while logging in
+                if not self.cancel_event.is_set():
+                    self.cancel_button["state"] = (
+                        tk.DISABLED if status == "logging in" else tk.NORMAL
+                    )
+
+            if not self.worker_process.is_alive():
                 self.change_all_state(tk.NORMAL)
+                return
+
+            try:
+                self.captcha_data_queue.get_nowait()
+            except queue.Empty:
+                pass
+            else:
+                self.captcha_window()
+            self.after(300, check_if_finished_or_captcha)
 
         self.change_all_state(tk.DISABLED)
         check_if_finished_or_captcha()
 
+    def cancel_processing(self) -> None:
+        """Stops the current job, the worker stays up for the next one"""
+        self.cancel_event.set()
+        self.cancel_button["state"] = tk.DISABLED
+
     def change_all_state(self, new_state) -> None:
         self.filebutton["state"] = new_state
         self.update_filebutton["state"] = new_state
@@ -241,6 +362,9 @@ class EnhanceExportGui(tk.Tk):
             self.forceentry.state(["!alternate", "!selected"])
             self.ignoreerrorsentry.state(["!alternate", "!selected"])
         self.start_button["state"] = new_state
+        self.cancel_button["state"] = (
+            tk.DISABLED if new_state == tk.NORMAL else tk.NORMAL
+        )
 
 
 def launch_gui() -> None:
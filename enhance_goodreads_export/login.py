@@ -1,11 +1,31 @@
+import re
 from typing import Callable
+from urllib.parse import urljoin
 
 import requests
+from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service as ChromeService
+from urllib3.util.request import ACCEPT_ENCODING
 from webdriver_manager.chrome import ChromeDriverManager
 
+from .config import LOGIN_URL
+from .config import MAX_POOLS
 from .config import POST_LOGIN_URL
+from .config import USER_AGENT
+from .entities import AbsoluteUrl
+from .entities import EnhanceExportException
+from .metadata1 import encrypt_metadata
+from .metadata1 import meta_goodreads_desktop
+
+
+class BrowserLoginRequiredException(EnhanceExportException):
+    """Signing in without a browser didn't work, but the credentials may be fine"""
+
+
+class CaptchaRequiredException(BrowserLoginRequiredException):
+    pass
 
 
 def default_login_prompt():
@@ -15,7 +35,123 @@ def default_login_prompt():
     )
 
 
-def login(login_prompt: Callable | None) -> requests.Session:
+def make_session(n_workers: int = 1) -> requests.Session:
+    """Session with a connection pool sized for n_workers concurrent requests"""
+    session = requests.Session()
+    # pool_block makes surplus requests wait for a free connection instead of
+    # opening (and then discarding) additional ones
+    adapter = HTTPAdapter(
+        pool_connections=MAX_POOLS, pool_maxsize=n_workers, pool_block=True
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # ACCEPT_ENCODING includes br / zstd only if the decoders are installed
+    session.headers.update(
+        {"accept-encoding": ACCEPT_ENCODING, "connection": "keep-alive"}
+    )
+    return session
+
+
+def connection_stats(session: requests.Session) -> tuple[int, int]:
+    """Returns (number of requests, number of opened connections)"""
+    n_requests = 0
+    n_connections = 0
+    for adapter in set(session.adapters.values()):
+        if not isinstance(adapter, HTTPAdapter):
+            continue
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            n_requests += pool.num_requests
+            n_connections += pool.num_connections
+    return n_requests, n_connections
+
+
+def format_connection_stats(session: requests.Session) -> str:
+    n_requests, n_connections = connection_stats(session)
+    if n_connections == 0:
+        return "Connection reuse: no requests made"
+    return (
+        f"Connection reuse: {n_requests} requests over {n_connections} connections"
+        f" ({n_requests / n_connections:.1f} requests per connection)"
+    )
+
+
+def is_captcha_page(soup: BeautifulSoup, url: str) -> bool:
+    return (
+        "/ap/cvf/" in url
+        or soup.find(id=re.compile("captcha", re.IGNORECASE)) is not None
+        or soup.find("input", attrs={"name": re.compile("^(guess|cvf_captcha_input)$")})
+        is not None
+    )
+
+
+def requests_login(
+    email: str,
+    password: str,
+    n_workers: int = 1,
+    sign_in_url: AbsoluteUrl = LOGIN_URL,
+) -> requests.Session:
+    """Logs in by submitting the sign-in form directly, without a browser
+
+    The form needs the bot detection "metadata1" field, which is generated by
+    the metadata1 module. Raises CaptchaRequiredException if a captcha (or other
+    verification step) is shown instead of the post-login page and
+    BrowserLoginRequiredException if the sign-in pages look different than
+    expected. Only a rejected email / password raises EnhanceExportException.
+    """
+    session = make_session(n_workers)
+    session.headers.update({"user-agent": USER_AGENT})
+
+    print("Getting sign-in page")
+    resp = session.get(sign_in_url, timeout=10)
+    resp.raise_for_status()
+    soup = BeautifulSoup(resp.content, "html.parser")
+    # the goodreads sign-in page only links to the (amazon) email sign-in form
+    email_link = soup.select_one('a[href*="ap/signin"]')
+    if email_link is not None:
+        resp = session.get(urljoin(resp.url, str(email_link["href"])), timeout=10)
+        resp.raise_for_status()
+        soup = BeautifulSoup(resp.content, "html.parser")
+
+    form = soup.select_one('form[name="signIn"]')
+    if form is None:
+        raise BrowserLoginRequiredException("Could not find sign-in form")
+    form_data = {
+        field["name"]: field.get("value", "")
+        for field in form.find_all("input")
+        if field.get("name")
+    }
+    form_data["email"] = email
+    form_data["password"] = password
+    form_data["metadata1"] = encrypt_metadata(
+        meta_goodreads_desktop(USER_AGENT, resp.url)
+    )
+
+    print("Submitting sign-in form")
+    form_url = urljoin(resp.url, str(form.get("action") or resp.url))
+    resp = session.post(form_url, data=form_data, timeout=10)
+    resp.raise_for_status()
+    soup = BeautifulSoup(resp.content, "html.parser")
+    if is_captcha_page(soup, resp.url):
+        raise CaptchaRequiredException("Sign-in requires solving a captcha")
+
+    # i.e. POST_LOGIN_URL, unless we are talking to a different sign-in server
+    post_login_url = urljoin(sign_in_url, "/")
+    if resp.url != post_login_url:
+        error_box = soup.find(id="auth-error-message-box")
+        if error_box is None:
+            raise BrowserLoginRequiredException(
+                f"Unexpected page after signing in: {resp.url}"
+            )
+        error = " ".join(error_box.get_text().split())
+        raise EnhanceExportException(f"Login failed ({error}), aborting!")
+    return session
+
+
+def browser_login(
+    login_prompt: Callable | None, n_workers: int = 1
+) -> requests.Session:
     if login_prompt is None:
         login_prompt = default_login_prompt
 
@@ -23,7 +159,7 @@ def login(login_prompt: Callable | None) -> requests.Session:
     driver = webdriver.Chrome(service=ChromeService(ChromeDriverManager().install()))
 
     print("Getting sign-in page and waiting for login")
-    driver.get("https://www.goodreads.com/user/sign_in")
+    driver.get(LOGIN_URL)
 
     login_prompt()
 
@@ -38,10 +174,31 @@ def login(login_prompt: Callable | None) -> requests.Session:
     user_agent = driver.execute_script("return navigator.userAgent;")
     driver.close()
 
-    session = requests.Session()
+    session = make_session(n_workers)
     for cookie in cookies:
         session.cookies.set(cookie["name"], cookie["value"])
 
     session.headers.update({"user-agent": user_agent})
 
     return session
+
+
+def login(
+    login_prompt: Callable | None,
+    n_workers: int = 1,
+    email: str | None = None,
+    password: str | None = None,
+) -> requests.Session:
+    """Logs in without a browser if credentials are given, falls back to the
+    interactive browser login if that's not possible (e.g. because of a captcha
+    or a changed sign-in page)
+    """
+    if email and password:
+        try:
+            return requests_login(email, password, n_workers)
+        except (
+            BrowserLoginRequiredException,
+            requests.exceptions.RequestException,
+        ) as e:
+            print(f"Could not log in without a browser ({e}), opening browser")
+    return browser_login(login_prompt, n_workers)
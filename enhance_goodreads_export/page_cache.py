@@ -0,0 +1,94 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any
+from typing import Callable
+from typing import Hashable
+
+
+class PageCache:
+    """Thread-safe cache of parsed page data, shared between workers (and exports)
+
+    Concurrent requests for the same key wait for the first fetch instead of
+    downloading the page again. Failed fetches are not cached, and entries older
+    than max_age seconds (if given) are fetched again. With max_entries the
+    oldest finished entries are dropped once there are more.
+    """
+
+    def __init__(
+        self, max_age: float | None = None, max_entries: int | None = None
+    ) -> None:
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: dict[Hashable, tuple[Future, float]] = {}
+        self.n_fetches: dict[str, int] = {}
+        self.n_hits = 0
+
+    def _is_expired(self, entry: tuple[Future, float], now: float) -> bool:
+        future, fetch_time = entry
+        return (
+            self.max_age is not None
+            and future.done()
+            and now - fetch_time > self.max_age
+        )
+
+    def get(self, kind: str, key: Hashable, fetch: Callable[[], Any]) -> Any:
+        with self._lock:
+            entry = self._entries.get((kind, key))
+            is_owner = entry is None or self._is_expired(entry, time.monotonic())
+            if not is_owner:
+                self.n_hits += 1
+            else:
+                self._entries.pop((kind, key), None)
+                entry = self._entries[(kind, key)] = (Future(), time.monotonic())
+                self.n_fetches[kind] = self.n_fetches.get(kind, 0) + 1
+                self._evict()
+        assert entry is not None
+        future = entry[0]
+        if not is_owner:
+            return future.result()
+
+        try:
+            result = fetch()
+        except BaseException as e:
+            with self._lock:
+                if self._entries.get((kind, key)) is entry:
+                    del self._entries[(kind, key)]
+            future.set_exception(e)
+            raise
+        future.set_result(result)
+        return result
+
+    def _evict(self) -> None:
+        """Drops the oldest finished entries above max_entries (holding the lock)"""
+        if self.max_entries is None:
+            return
+        n_excess = len(self._entries) - self.max_entries
+        if n_excess <= 0:
+            return
+        # entries are in insertion order, i.e. oldest first
+        for key in [k for k, (f, _) in self._entries.items() if f.done()][:n_excess]:
+            del self._entries[key]
+
+    def contains(self, kind: str, key: Hashable) -> bool:
+        """Whether the page is cached (or being fetched) and not expired"""
+        with self._lock:
+            entry = self._entries.get((kind, key))
+            return entry is not None and not self._is_expired(entry, time.monotonic())
+
+    def prune(self) -> None:
+        """Drops expired entries"""
+        with self._lock:
+            now = time.monotonic()
+            for key in [
+                k for k, e in self._entries.items() if self._is_expired(e, now)
+            ]:
+                del self._entries[key]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> str:
+        fetches = ", ".join(f"{n} {kind} pages" for kind, n in self.n_fetches.items())
+        return f"Fetched {fetches or 'no pages'} ({self.n_hits} cache hits)"
@@ -0,0 +1,160 @@
+import datetime
+import json
+from dataclasses import dataclass
+from dataclasses import field
+
+from .config import DEFAULT_REQUESTS_PER_SEC
+from .config import SHELVES_WITHOUT_READ_DATES
+from .config import THROUGHPUT_FILE
+from .config import THROUGHPUT_MIN_REQUESTS
+from .page_cache import PageCache
+from .progress import format_duration
+
+
+def needs_review_page(book: dict[str, str]) -> bool:
+    """Whether the review page can have read dates for the book
+
+    Books on a shelf like to-read that have never been read don't have any,
+    their read_dates are left empty without fetching the page.
+    """
+    return not (
+        book.get("Exclusive Shelf") in SHELVES_WITHOUT_READ_DATES
+        and not book.get("Date Read")
+    )
+
+
+@dataclass
+class RequestPlan:
+    """The books to process and the page fetches that needs, by URL kind"""
+
+    jobs: list[tuple[int, dict[str, str]]] = field(default_factory=list)
+    # rows with the same Book Id (in the same export) as a job's book,
+    # keyed by id() of that book, they get a copy of its results
+    duplicates: dict[int, list[dict[str, str]]] = field(default_factory=dict)
+    n_requests: dict[str, int] = field(default_factory=dict)
+    n_rows: int = 0
+    n_up_to_date: int = 0
+    n_no_review_page: int = 0
+    n_cached: int = 0
+
+    @property
+    def n_total_requests(self) -> int:
+        return sum(self.n_requests.values())
+
+    def describe(self) -> str:
+        n_duplicates = sum(len(rows) for rows in self.duplicates.values())
+        requests = ", ".join(f"{n} {kind}" for kind, n in self.n_requests.items())
+        lines = [
+            (
+                f"{len(self.jobs)} of {self.n_rows} books need processing"
+                f" ({self.n_up_to_date} already enhanced, {n_duplicates} duplicate"
+                " rows)"
+            ),
+            f"Planned requests: {requests or 'none'} ({self.n_total_requests} total)",
+        ]
+        if self.n_no_review_page:
+            lines.append(
+                f"Skipping the review page of {self.n_no_review_page} unread books"
+            )
+        if self.n_cached:
+            lines.append(f"{self.n_cached} book pages are already cached")
+        if "shelves" in self.n_requests:
+            lines.append(
+                "(shelves pages are an upper bound, books of the same work share one)"
+            )
+        return "\n".join(lines)
+
+
+def plan_requests(
+    exports: list[list[dict[str, str]]],
+    n_rows: int,
+    ratings_only: bool = False,
+    cache: PageCache | None = None,
+) -> RequestPlan:
+    """Plans the fetches for the books to process of each export
+
+    Every Book Id is only processed once per export (the review page belongs
+    to the export's user), book, shelves and ratings pages once overall.
+    Pages that are already in the cache aren't counted.
+    """
+    plan = RequestPlan(n_rows=n_rows)
+    book_ids = set()
+    for export_index, books in enumerate(exports):
+        first_by_id: dict[str, dict[str, str]] = {}
+        for book in books:
+            first = first_by_id.get(book["Book Id"])
+            if first is not None:
+                plan.duplicates.setdefault(id(first), []).append(book)
+                continue
+            first_by_id[book["Book Id"]] = book
+            plan.jobs.append((export_index, book))
+            book_ids.add(book["Book Id"])
+            if ratings_only:
+                continue
+            if needs_review_page(book):
+                plan.n_requests["review"] = plan.n_requests.get("review", 0) + 1
+            else:
+                plan.n_no_review_page += 1
+    plan.n_up_to_date = n_rows - sum(len(books) for books in exports)
+
+    kind = "n_ratings" if ratings_only else "book"
+    if cache is not None:
+        plan.n_cached = sum(cache.contains(kind, book_id) for book_id in book_ids)
+    n_pages = len(book_ids) - plan.n_cached
+    if n_pages:
+        plan.n_requests[kind] = n_pages
+        if not ratings_only:
+            plan.n_requests["shelves"] = n_pages
+    return plan
+
+
+def load_throughput() -> tuple[float, int] | None:
+    """Returns (requests per second, number of workers) of the last run"""
+    try:
+        with open(THROUGHPUT_FILE) as f:
+            stats = json.load(f)
+        return float(stats["requests_per_sec"]), int(stats["workers"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_throughput(n_requests: int, elapsed: float, n_workers: int) -> None:
+    """Remembers the throughput of this run for estimates (if it was long enough)"""
+    if n_requests < THROUGHPUT_MIN_REQUESTS or elapsed <= 0:
+        return
+    try:
+        with open(THROUGHPUT_FILE, "w") as f:
+            json.dump(
+                {
+                    "requests_per_sec": n_requests / elapsed,
+                    "workers": n_workers,
+                    "n_requests": n_requests,
+                    "time": datetime.datetime.now().isoformat(timespec="seconds"),
+                },
+                f,
+            )
+    except OSError as e:
+        print(f"Could not save throughput to {THROUGHPUT_FILE}: {e}")
+
+
+def estimate_duration(plan: RequestPlan, n_workers: int) -> str:
+    """Estimated duration of the plan, from the throughput of the last run
+
+    The measured rate is scaled by the number of workers, which is optimistic
+    for many workers.
+    """
+    throughput = load_throughput()
+    if throughput is None:
+        per_worker = DEFAULT_REQUESTS_PER_SEC
+        source = (
+            f"no measured throughput yet, assuming {per_worker:g} requests/s per worker"
+        )
+    else:
+        requests_per_sec, measured_workers = throughput
+        per_worker = requests_per_sec / max(measured_workers, 1)
+        source = (
+            f"last run: {requests_per_sec:.2f} requests/s with"
+            f" {measured_workers} workers"
+        )
+    seconds = plan.n_total_requests / (per_worker * n_workers)
+    return f"Estimated duration: {format_duration(seconds)} ({source})"
@@ -0,0 +1,95 @@
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+
+@dataclass
+class ProgressEvent:
+    kind: str  # "started", "finished" or "error"
+    n_done: int
+    n_total: int
+    n_errors: int
+    title: str
+    author: str
+    books_per_sec: float
+    eta_sec: float | None
+    message: str = ""
+
+
+ProgressCallback = Callable[[ProgressEvent], None]
+
+
+def format_duration(seconds: float | None) -> str:
+    if seconds is None:
+        return "?"
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes}:{seconds:02}"
+
+
+def format_progress(event: ProgressEvent) -> str:
+    errors = f", {event.n_errors} errors" if event.n_errors else ""
+    return (
+        f"{event.n_done} of {event.n_total} books done{errors}"
+        f" ({event.books_per_sec:.2f} books/s, ETA {format_duration(event.eta_sec)})"
+        f" - {event.title} ({event.author})"
+    )
+
+
+class ProgressTracker:
+    """Turns book started / finished notifications into ProgressEvents"""
+
+    def __init__(self, n_total: int, callback: ProgressCallback) -> None:
+        self.n_total = n_total
+        self.callback = callback
+        self.n_done = 0
+        self.n_errors = 0
+        self.start_time = time.monotonic()
+
+    def _emit(self, kind: str, book: dict[str, str], message: str = "") -> None:
+        elapsed = time.monotonic() - self.start_time
+        books_per_sec = self.n_done / elapsed if elapsed > 0 else 0
+        self.callback(
+            ProgressEvent(
+                kind=kind,
+                n_done=self.n_done,
+                n_total=self.n_total,
+                n_errors=self.n_errors,
+                title=book.get("Title", ""),
+                author=book.get("Author", ""),
+                books_per_sec=books_per_sec,
+                eta_sec=(
+                    (self.n_total - self.n_done) / books_per_sec
+                    if books_per_sec
+                    else None
+                ),
+                message=message,
+            )
+        )
+
+    def started(self, book: dict[str, str]) -> None:
+        self._emit("started", book)
+
+    def finished(self, book: dict[str, str], error: Exception | None) -> None:
+        self.n_done += 1
+        if error is not None:
+            self.n_errors += 1
+            self._emit("error", book, str(error))
+        else:
+            self._emit("finished", book)
+
+
+class ProgressPrinter:
+    """Prints progress at most every min_interval seconds (and at the end)"""
+
+    def __init__(self, min_interval: float = 2) -> None:
+        self.min_interval = min_interval
+        self.last_print = 0.0
+
+    def __call__(self, event: ProgressEvent) -> None:
+        now = time.monotonic()
+        if now - self.last_print >= self.min_interval or (
+            event.n_done == event.n_total and event.kind != "started"
+        ):
+            self.last_print = now
+            print(format_progress(event))
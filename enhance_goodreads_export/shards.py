@@ -0,0 +1,80 @@
+import os
+import zlib
+
+from .config import ENHANCED_FIELDNAMES
+from .enhance_export import parse_csv
+from .enhance_export import write_csv
+from .entities import EnhanceExportException
+from .entities import Path
+
+
+def parse_shard_spec(spec: str) -> tuple[int, int]:
+    """Parses "K/N" (shard K of N, 1-based) into (K, N)"""
+    try:
+        shard_str, n_shards_str = spec.split("/")
+        shard, n_shards = int(shard_str), int(n_shards_str)
+    except ValueError:
+        raise EnhanceExportException(
+            f'Invalid shard "{spec}", expected K/N, e.g. "1/4"'
+        )
+    if not 1 <= shard <= n_shards:
+        raise EnhanceExportException(
+            f'Invalid shard "{spec}", K must be between 1 and N'
+        )
+    return shard, n_shards
+
+
+def book_shard(book_id: str, n_shards: int) -> int:
+    # crc32 instead of hash() so the assignment is the same on every machine / run
+    return zlib.crc32(book_id.strip().encode("utf-8")) % n_shards + 1
+
+
+def shard_filename(filename: Path, shard: int, n_shards: int) -> Path:
+    root, ext = os.path.splitext(filename)
+    return Path(f"{root}.shard{shard}of{n_shards}{ext or '.csv'}")
+
+
+def merge_shards(export_filename: Path, shard_filenames: list[Path]) -> None:
+    """Adds the results of all shard files to the export file
+
+    Rows without any results (not processed yet, or failed) don't count, so this
+    fails if a book in the export file has no results in any shard file or if
+    two shard files contain different results for the same book. Empty shard
+    values never overwrite values that are already in the export file.
+    """
+    books = parse_csv(export_filename)
+    input_columns = list(books[0].keys()) if books else []
+    output_columns = input_columns + [
+        c for c in ENHANCED_FIELDNAMES if c not in input_columns
+    ]
+
+    results: dict[str, dict[str, str]] = {}
+    result_sources: dict[str, Path] = {}
+    for filename in shard_filenames:
+        for shard_book in parse_csv(filename):
+            book_id = shard_book["Book Id"]
+            result = {c: shard_book.get(c, "") for c in ENHANCED_FIELDNAMES}
+            if not any(result.values()):
+                continue
+            if book_id in results and results[book_id] != result:
+                raise EnhanceExportException(
+                    f"Conflicting results for book {book_id} ({shard_book['Title']})"
+                    f" in {result_sources[book_id]} and {filename}, aborting!"
+                )
+            results[book_id] = result
+            result_sources[book_id] = filename
+
+    missing = [b for b in books if b["Book Id"] not in results]
+    if missing:
+        raise EnhanceExportException(
+            f"{len(missing)} books have no results in any shard file (e.g."
+            f" {missing[0]['Title']}), did all shards finish without errors?"
+        )
+    n_unknown = len(results.keys() - {b["Book Id"] for b in books})
+    if n_unknown:
+        print(f"Ignoring {n_unknown} books in shard files that are not in the export")
+
+    for book in books:
+        book.update({c: v for c, v in results[book["Book Id"]].items() if v})
+    write_csv(books, output_columns, export_filename)
+    print(f"Merged {len(shard_filenames)} shard files into {export_filename}")
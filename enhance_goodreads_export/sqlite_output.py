@@ -0,0 +1,117 @@
+import sqlite3
+import threading
+
+from .entities import EnhanceExportException
+from .entities import Path
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    source TEXT NOT NULL,
+    book_id TEXT NOT NULL,
+    title TEXT,
+    author TEXT,
+    exclusive_shelf TEXT,
+    n_pages INTEGER,
+    n_ratings INTEGER,
+    PRIMARY KEY (source, book_id)
+);
+CREATE TABLE IF NOT EXISTS reading_sessions (
+    source TEXT NOT NULL,
+    book_id TEXT NOT NULL,
+    start_date TEXT,
+    end_date TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reading_sessions_end_date
+    ON reading_sessions (end_date);
+CREATE INDEX IF NOT EXISTS reading_sessions_book
+    ON reading_sessions (source, book_id);
+CREATE TABLE IF NOT EXISTS book_genres (
+    source TEXT NOT NULL,
+    book_id TEXT NOT NULL,
+    genre TEXT NOT NULL,
+    votes INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS book_genres_genre ON book_genres (genre);
+CREATE INDEX IF NOT EXISTS book_genres_book ON book_genres (source, book_id);
+"""
+
+
+def to_int(value: str | None) -> int | None:
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+class SqliteOutput:
+    """Normalized copy of the enhanced export(s) in an SQLite database
+
+    read_dates and genres are split into one row per reading session / genre.
+    Rows are keyed by source (the export file) and Book Id, writing a book again
+    replaces its previous rows. Books are committed as they are written, so the
+    database is usable while a run is still going.
+    """
+
+    def __init__(self, filename: Path) -> None:
+        try:
+            self.connection = sqlite3.connect(filename, check_same_thread=False)
+            self.connection.executescript(SCHEMA)
+        except sqlite3.Error as e:
+            raise EnhanceExportException(f"Error opening database: {e}")
+        self._lock = threading.Lock()
+
+    def write_book(self, source: str, book: dict[str, str]) -> None:
+        self.write_books(source, [book])
+
+    def write_books(self, source: str, books: list[dict[str, str]]) -> None:
+        """Writes the books in one transaction"""
+        try:
+            with self._lock, self.connection:
+                for book in books:
+                    self._insert_book(source, book)
+        except sqlite3.Error as e:
+            raise EnhanceExportException(f"Error writing to database: {e}")
+
+    def _insert_book(self, source: str, book: dict[str, str]) -> None:
+        book_id = book["Book Id"]
+        # entries that aren't "start,end" / "genre|votes" (e.g. a hand-edited
+        # --update file) are left out
+        readings = [
+            reading.split(",")
+            for reading in book.get("read_dates", "").split(";")
+            if reading.count(",") == 1
+        ]
+        genres = [
+            genre.rsplit("|", 1)
+            for genre in book.get("genres", "").split(";")
+            if "|" in genre
+        ]
+        for table in ["books", "reading_sessions", "book_genres"]:
+            self.connection.execute(
+                f"DELETE FROM {table} WHERE source = ? AND book_id = ?",
+                (source, book_id),
+            )
+        self.connection.execute(
+            "INSERT INTO books VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                source,
+                book_id,
+                book.get("Title"),
+                book.get("Author"),
+                book.get("Exclusive Shelf"),
+                to_int(book.get("Number of Pages")),
+                to_int(book.get("n_ratings")),
+            ),
+        )
+        self.connection.executemany(
+            "INSERT INTO reading_sessions VALUES (?, ?, ?, ?)",
+            [(source, book_id, start or None, end) for start, end in readings],
+        )
+        self.connection.executemany(
+            "INSERT INTO book_genres VALUES (?, ?, ?, ?)",
+            [(source, book_id, genre, to_int(votes) or 0) for genre, votes in genres],
+        )
+
+    def close(self) -> None:
+        self.connection.close()
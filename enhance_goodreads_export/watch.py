@@ -0,0 +1,165 @@
+import dataclasses
+import json
+import os
+import time
+from typing import Callable
+
+import requests
+
+from .circuit_breaker import CircuitBreaker
+from .circuit_breaker import CircuitOpenException
+from .circuit_breaker import SignedOutException
+from .config import BASE_URL
+from .config import PERSISTENT_CACHE_MAX_AGE
+from .config import WATCH_OUTPUT_DIR
+from .config import WATCH_POLL_INTERVAL
+from .enhance_export import load_export
+from .enhance_export import parse_genre_votes
+from .enhance_export import process_exports
+from .entities import EnhanceExportException
+from .entities import Path
+from .login import format_connection_stats
+from .login import login
+from .page_cache import PageCache
+from .progress import ProgressCallback
+from .sqlite_output import SqliteOutput
+
+
+def find_new_exports(directory: Path, processed: dict[str, float]) -> list[Path]:
+    """.csv files in directory that are new or changed since they were processed
+
+    Files modified in the last poll interval are skipped, they might still be
+    being written. Files that disappear while scanning are skipped too.
+    """
+    now = time.time()
+    candidates = []
+    for entry in os.scandir(directory):
+        try:
+            if not entry.is_file() or not entry.name.lower().endswith(".csv"):
+                continue
+            mtime = entry.stat().st_mtime
+        except OSError:
+            continue
+        if processed.get(entry.path) != mtime and now - mtime > WATCH_POLL_INTERVAL:
+            candidates.append((mtime, Path(entry.path)))
+    return [filename for _, filename in sorted(candidates)]
+
+
+def write_status(filename: Path, status: dict) -> None:
+    try:
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump(status, f, indent=2)
+    except OSError as e:
+        print(f"Could not write status file: {e}")
+
+
+def watch_directory(
+    options: dict,
+    login_prompt: Callable | None = None,
+    progress: ProgressCallback | None = None,
+) -> None:
+    """Enhances every export file that appears in options["watch"]
+
+    Logs in once and keeps the session, page cache and circuit breaker for all
+    files. Results are written to the WATCH_OUTPUT_DIR subdirectory, a file that
+    was processed before is updated from its previous result (like --update).
+    Queue depth and throughput are written to status.json in that directory.
+    A file that fails (without --ignore_errors, on the first failing book) is
+    skipped until it changes, if GoodReads logged us out we log in again.
+    """
+    directory = Path(options["watch"])
+    output_directory = Path(os.path.join(directory, WATCH_OUTPUT_DIR))
+    status_filename = Path(os.path.join(output_directory, "status.json"))
+    try:
+        os.makedirs(output_directory, exist_ok=True)
+    except OSError as e:
+        raise EnhanceExportException(f"Could not create output directory: {e}")
+
+    parse_genre_votes(options)
+
+    def do_login() -> requests.Session:
+        return login(
+            login_prompt=login_prompt,
+            n_workers=options.get("workers") or 1,
+            email=options.get("email"),
+            password=options.get("password"),
+        )
+
+    session = do_login()
+    cache = PageCache(max_age=PERSISTENT_CACHE_MAX_AGE)
+    breaker = CircuitBreaker(BASE_URL)
+    sqlite = SqliteOutput(options["sqlite"]) if options.get("sqlite") else None
+
+    processed: dict[str, float] = {}
+    n_files = 0
+    n_books = 0
+    processing_time = 0.0
+    print(f"Watching {directory} for new export files (press ctrl+c to stop)")
+    while True:
+        queue = find_new_exports(directory, processed)
+        for i, filename in enumerate(queue):
+            try:
+                mtime = os.stat(filename).st_mtime
+            except OSError:
+                # renamed or moved away since the scan
+                print(f"{filename} is gone, skipping")
+                continue
+            output_filename = Path(
+                os.path.join(output_directory, os.path.basename(filename))
+            )
+            print(f"Processing {filename} ({len(queue) - i - 1} more files queued)")
+            start = time.monotonic()
+            try:
+                export = load_export(
+                    filename,
+                    output_filename if os.path.exists(output_filename) else None,
+                    options,
+                )
+                export = dataclasses.replace(export, filename=output_filename)
+                process_exports(
+                    [(export, session)], options, cache, progress, breaker, sqlite
+                )
+            except SignedOutException as e:
+                print(f"{e.message} Logging in again, will retry {filename}.")
+                session = do_login()
+                breaker = CircuitBreaker(BASE_URL)
+                break
+            except CircuitOpenException as e:
+                # leave the file in the queue and try again with a fresh breaker
+                print(f"{e.message} Will retry {filename} later.")
+                breaker = CircuitBreaker(BASE_URL)
+                break
+            except EnhanceExportException as e:
+                print(f"Error processing {filename}, skipping: {e.message}")
+            except Exception as e:
+                # e.g. a removed book without --ignore_errors, the file is only
+                # tried again once it changes
+                print(f"Error processing {filename}, skipping: {e!r}")
+            else:
+                n_files += 1
+                n_books += len(export.books_to_process)
+            processed[filename] = mtime
+            processing_time += time.monotonic() - start
+            cache.prune()
+
+            write_status(
+                status_filename,
+                {
+                    "queue_depth": len(queue) - i - 1,
+                    "files_processed": n_files,
+                    "books_processed": n_books,
+                    "books_per_sec": n_books / processing_time
+                    if processing_time
+                    else 0,
+                    "cached_pages": len(cache),
+                    "last_file": filename,
+                    "last_file_seconds": time.monotonic() - start,
+                    "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                },
+            )
+            print(
+                f"Finished {filename} in {time.monotonic() - start:.1f}s, {n_files}"
+                f" files / {n_books} books processed so far, {cache.stats()}"
+            )
+            print(format_connection_stats(session))
+        time.sleep(WATCH_POLL_INTERVAL)